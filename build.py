@@ -2,17 +2,21 @@
 
 import os
 import pathlib
-import platform
+import re
+import fnmatch
 import zipfile
 import urllib.request
 import shutil
 import hashlib
+import subprocess
 import argparse
+import json
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-windows = platform.platform().startswith('Windows')
-osx = platform.platform().startswith(
-    'Darwin') or platform.platform().startswith("macOS")
+windows = sys.platform.startswith('win')
+osx = sys.platform == 'darwin'
 hbb_name = 'rustdesk' + ('.exe' if windows else '')
 exe_path = 'target/release/' + hbb_name
 if windows:
@@ -32,19 +36,59 @@ def get_arch() -> str:
     return custom_arch
 
 
+def get_deb_compression() -> str:
+    # zstd packs the deb several times faster than dpkg's default xz.
+    # dpkg before 1.21.18 (e.g. Debian 11) can not install zstd packages,
+    # set DEB_COMPRESSION=xz to build for those.
+    return os.environ.get("DEB_COMPRESSION", "zstd")
+
+
 def system2(cmd):
-    err = os.system(cmd)
+    # A string is run through the shell, a list is executed directly.
+    # close_fds=False lets subprocess use posix_spawn/vfork instead of
+    # fork + closing every possible fd, which is slow with a high NOFILE limit.
+    try:
+        err = subprocess.run(cmd, shell=isinstance(cmd, str), close_fds=False).returncode
+    except OSError as e:
+        print(e)
+        err = -1
     if err != 0:
         print(f"Error occurred when executing: {cmd}. Exiting.")
         sys.exit(-1)
 
 
+def replace_in_file(path, subs):
+    # Apply (pattern, replacement) regex substitutions in place, like
+    # `sed -i -e ... -e ...` but with a single read and write and no process.
+    with open(path, encoding='utf-8', newline='') as fh:
+        content = fh.read()
+    for (pattern, repl) in subs:
+        content = re.sub(pattern, repl, content, flags=re.M)
+    with open(path, 'w', encoding='utf-8', newline='') as fh:
+        fh.write(content)
+
+
+def setup_cargo_cache():
+    # Let sccache cache crate compilation across builds if it is installed
+    # and no other rustc wrapper is configured. sccache keys on the compiler
+    # version, arguments and sources, so this is safe for every feature set.
+    if os.environ.get('RUSTC_WRAPPER'):
+        return
+    sccache = shutil.which('sccache')
+    if not sccache:
+        return
+    print(f'Use sccache: {sccache}')
+    os.environ['RUSTC_WRAPPER'] = sccache
+    # sccache can not cache incremental compilation
+    os.environ['CARGO_INCREMENTAL'] = '0'
+
+
 def get_version():
-    with open("Cargo.toml", encoding="utf-8") as fh:
-        for line in fh:
-            if line.startswith("version"):
-                return line.replace("version", "").replace("=", "").replace('"', '').strip()
-    return ''
+    # the package version is at the top of the manifest, no need to read it all
+    with open("Cargo.toml", "rb") as fh:
+        head = fh.read(4096)
+    m = re.search(rb'^version\s*=\s*"([^"]+)"', head, re.M)
+    return m.group(1).decode() if m else ''
 
 
 def parse_rc_features(feature):
@@ -69,11 +113,22 @@ def parse_rc_features(feature):
         else:
             return 'linux' in platforms
 
+    def compile_patterns(feat_info):
+        # Fuse the include/exclude lists into one regex each, so a zip entry
+        # is matched with a single call.
+        def fuse(patterns):
+            if not patterns:
+                return None
+            return re.compile('|'.join(f'(?:{p})' for p in patterns))
+        return dict(feat_info,
+                    include_re=fuse(feat_info.get('include')),
+                    exclude_re=fuse(feat_info.get('exclude')))
+
     def get_all_features():
-        features = []
+        features = {}
         for (feat, feat_info) in available_features.items():
             if platform_check(feat_info['platform']):
-                features.append(feat)
+                features[feat] = compile_patterns(feat_info)
         return features
 
     if isinstance(feature, str) and feature.upper() == 'ALL':
@@ -89,7 +144,7 @@ def parse_rc_features(feature):
                 return get_all_features()
             if feat in available_features:
                 if platform_check(available_features[feat]['platform']):
-                    apply_features[feat] = available_features[feat]
+                    apply_features[feat] = compile_patterns(available_features[feat])
             else:
                 print(f'Unrecognized feature {feat}')
         return apply_features
@@ -160,6 +215,21 @@ def make_parser():
     return parser
 
 
+def set_flutter_bridge_cpath():
+    # Point CPATH at the GCC installation clang selected, for the
+    # flutter_rust_bridge codegen.
+    try:
+        out = subprocess.run(['clang', '-v'], capture_output=True, text=True).stderr
+    except OSError as e:
+        print(f'Failed to run clang: {e}')
+        return
+    for line in out.splitlines():
+        if line.startswith('Selected GCC installation:'):
+            os.environ['CPATH'] = line.split(': ', 1)[1].strip() + '/include'
+            return
+    print('No GCC installation found by clang, CPATH not set')
+
+
 # Generate build script for docker
 #
 # it assumes all build dependencies are installed in environments
@@ -168,8 +238,6 @@ def generate_build_script_for_docker():
     with open("/tmp/build.sh", "w") as f:
         f.write('''
             #!/bin/bash
-            # environment
-            export CPATH="$(clang -v 2>&1 | grep "Selected GCC installation: " | cut -d' ' -f4-)/include"
             # flutter
             pushd /opt
             wget https://storage.googleapis.com/flutter_infra_release/releases/stable/linux/flutter_linux_3.0.5-stable.tar.xz
@@ -192,7 +260,8 @@ def generate_build_script_for_docker():
             # build rustdesk
             ./build.py --flutter --hwcodec
         ''')
-    system2("chmod +x /tmp/build.sh")
+    os.chmod("/tmp/build.sh", 0o755)
+    set_flutter_bridge_cpath()
     system2("bash /tmp/build.sh")
 
 
@@ -200,8 +269,6 @@ def generate_build_script_for_docker():
 # We can use this function in an offline build environment.
 # Even in an online environment, we recommend building third-party resources yourself.
 def download_extract_features(features, res_dir):
-    import re
-
     proxy = ''
 
     def req(url):
@@ -213,47 +280,112 @@ def download_extract_features(features, res_dir):
             r.set_proxy(proxy, 'https')
             return r
 
-    for (feat, feat_info) in features.items():
-        includes = feat_info['include'] if 'include' in feat_info and feat_info['include'] else []
-        includes = [re.compile(p) for p in includes]
-        excludes = feat_info['exclude'] if 'exclude' in feat_info and feat_info['exclude'] else []
-        excludes = [re.compile(p) for p in excludes]
-
+    def _fetch_one(feat, feat_info):
         print(f'{feat} download begin')
         download_filename = feat_info['zip_url'].split('/')[-1]
         checksum_md5_response = urllib.request.urlopen(
             req(feat_info['checksum_url']))
+        checksums = {}
         for line in checksum_md5_response.read().decode('utf-8').splitlines():
-            if line.split()[1] == download_filename:
-                checksum_md5 = line.split()[0]
-                filename, _headers = urllib.request.urlretrieve(feat_info['zip_url'],
-                                                                download_filename)
-                md5 = hashlib.md5(open(filename, 'rb').read()).hexdigest()
-                if checksum_md5 != md5:
-                    raise Exception(f'{feat} download failed')
-                print(f'{feat} download end. extract bein')
-                zip_file = zipfile.ZipFile(filename)
-                zip_list = zip_file.namelist()
-                for f in zip_list:
-                    file_exclude = False
-                    for p in excludes:
-                        if p.match(f) is not None:
-                            file_exclude = True
-                            break
-                    if file_exclude:
-                        continue
-
-                    file_include = False if includes else True
-                    for p in includes:
-                        if p.match(f) is not None:
-                            file_include = True
-                            break
-                    if file_include:
-                        print(f'extract file {f}')
-                        zip_file.extract(f, res_dir)
-                zip_file.close()
-                os.remove(download_filename)
+            parts = line.split()
+            if len(parts) >= 2:
+                checksums[parts[1]] = parts[0]
+        checksum_md5 = checksums.get(download_filename)
+        if checksum_md5 is None:
+            print(f'{feat} checksum of {download_filename} not found, skip')
+            return None
+
+        # hash while downloading, so the zip is neither buffered in memory
+        # nor read back from disk
+        md5 = hashlib.md5()
+        fh = tempfile.NamedTemporaryFile(suffix=f'-{download_filename}', delete=False)
+        try:
+            with urllib.request.urlopen(req(feat_info['zip_url'])) as resp, fh:
+                while chunk := resp.read(65536):
+                    md5.update(chunk)
+                    fh.write(chunk)
+            if checksum_md5 != md5.hexdigest():
+                raise Exception(f'{feat} download failed')
+        except BaseException:
+            os.remove(fh.name)
+            raise
+        print(f'{feat} download end')
+        return fh.name
+
+    def _extract_members(feat, filename, infos):
+        if not infos:
+            return
+        # Create parent directories up front, so the workers do not race on
+        # creating them. Drop the components ZipFile.extract() drops as well.
+        for info in infos:
+            parts = [p for p in info.filename.split('/')[:-1] if p not in ('', '.', '..')]
+            os.makedirs(os.path.join(res_dir, *parts), exist_ok=True)
+
+        # zlib releases the GIL while inflating, so members can be extracted
+        # in parallel. ZipFile objects are not shared between threads, the
+        # ZipInfo entries are passed along so the name is not looked up again.
+        # The stream checks each member against its stored CRC-32 (zlib.crc32)
+        # as it is written and raises BadZipFile on a mismatch.
+        def extract(infos):
+            with zipfile.ZipFile(filename) as zf:
+                for info in infos:
+                    print(f'extract file {info.filename}')
+                    try:
+                        zf.extract(info, res_dir)
+                    except zipfile.BadZipFile as e:
+                        raise Exception(f'{feat} extract {info.filename} failed: {e}')
+
+        workers = min(os.cpu_count() or 1, len(infos))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(extract, [infos[i::workers] for i in range(workers)]))
+
+    with ThreadPoolExecutor(max_workers=min(8, len(features))) as executor:
+        futures = {executor.submit(_fetch_one, feat, feat_info): feat
+                   for (feat, feat_info) in features.items()}
+        pending = set(futures)
+        try:
+            for future in as_completed(futures):
+                pending.discard(future)
+                feat = futures[future]
+                filename = future.result()
+                if filename is None:
+                    continue
+                include_re = features[feat]['include_re']
+                exclude_re = features[feat]['exclude_re']
+
+                print(f'{feat} extract begin')
+                try:
+                    to_extract = []
+                    with zipfile.ZipFile(filename) as zip_file:
+                        for info in zip_file.infolist():
+                            name = info.filename
+                            if exclude_re and exclude_re.match(name):
+                                continue
+                            if include_re is None or include_re.match(name):
+                                to_extract.append(info)
+                    _extract_members(feat, filename, to_extract)
+                finally:
+                    os.remove(filename)
                 print(f'{feat} extract end')
+        finally:
+            # On an error, drop the zips other workers already downloaded
+            for future in pending:
+                if future.cancel() or future.exception() is not None:
+                    continue
+                if future.result() is not None:
+                    os.remove(future.result())
+
+
+def _link_or_copy(src, dst):
+    # Hard link when possible, res_dir and the flutter build directory are
+    # usually on the same file system.
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
 
 
 def external_resources(flutter, args, res_dir):
@@ -270,12 +402,15 @@ def external_resources(flutter, args, res_dir):
     download_extract_features(features, res_dir)
     if flutter:
         os.makedirs(flutter_build_dir_2, exist_ok=True)
-        for f in pathlib.Path(res_dir).iterdir():
-            print(f'{f}')
-            if f.is_file():
-                shutil.copy2(f, flutter_build_dir_2)
-            else:
-                shutil.copytree(f, f'{flutter_build_dir_2}{f.stem}')
+        with os.scandir(res_dir) as it:
+            for f in it:
+                print(f'{f.path}')
+                dst = os.path.join(flutter_build_dir_2, f.name)
+                if f.is_file():
+                    _link_or_copy(f.path, dst)
+                else:
+                    shutil.copytree(f.path, dst, copy_function=_link_or_copy,
+                                    dirs_exist_ok=True)
 
 
 def get_features(args):
@@ -297,10 +432,7 @@ def get_features(args):
     return features
 
 
-def generate_control_file(version):
-    control_file_path = "../res/DEBIAN/control"
-    system2('/bin/rm -rf %s' % control_file_path)
-
+def generate_control_file(version, control_file_path):
     content = """Package: rustdesk
 Version: %s
 Architecture: %s
@@ -310,15 +442,136 @@ Depends: libgtk-3-0, libxcb-randr0, libxdo3, libxfixes3, libxcb-shape0, libxcb-x
 Description: A remote control software.
 
 """ % (version, get_arch())
-    file = open(control_file_path, "w")
-    file.write(content)
-    file.close()
+    with open(control_file_path, 'w') as f:
+        f.write(content)
 
 
 def ffi_bindgen_function_refactor():
     # workaround ffigen
-    system2(
-        'sed -i "s/ffi.NativeFunction<ffi.Bool Function(DartPort/ffi.NativeFunction<ffi.Uint8 Function(DartPort/g" flutter/lib/generated_bridge.dart')
+    replace_in_file('flutter/lib/generated_bridge.dart', [
+        (re.escape('ffi.NativeFunction<ffi.Bool Function(DartPort'),
+         'ffi.NativeFunction<ffi.Uint8 Function(DartPort'),
+    ])
+
+
+def _stage_deb_tree(dst_root, pairs, dirs=()):
+    # Populate a deb staging tree in-process instead of one mkdir/cp process
+    # per file. `pairs` are (src, dst) tuples with dst relative to dst_root,
+    # a directory src is merged into dst. `dirs` are extra (empty) directories.
+    dirs = list(dirs)
+    dirs += [dst if os.path.isdir(src) else os.path.dirname(dst) for (src, dst) in pairs]
+    for d in dirs:
+        os.makedirs(os.path.join(dst_root, d), exist_ok=True)
+    for (src, dst) in pairs:
+        dst = os.path.join(dst_root, dst)
+        if os.path.isdir(src):
+            shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+        else:
+            shutil.copy2(src, dst)
+
+
+def _write_polkit_stub(dst_root):
+    polkit = os.path.join(dst_root, 'usr/share/rustdesk/files/polkit')
+    with open(polkit, 'a') as f:
+        f.write('#!/bin/sh\n')
+    os.chmod(polkit, os.stat(polkit).st_mode | 0o111)
+
+
+def get_cache_dir(*parts):
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'rustdesk-build', *parts)
+
+
+def _hash_inputs(h, paths, skip=()):
+    # Hash names and contents of the given files and directory trees in a
+    # stable order. Missing paths and those matching a `skip` pattern
+    # (fnmatch) are skipped.
+    def skipped(p):
+        return any(fnmatch.fnmatch(p, pat) for pat in skip)
+
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = []
+            for (root, dirs, names) in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not skipped(os.path.join(root, d)))
+                files += [os.path.join(root, f) for f in sorted(names)]
+        for f in files:
+            if os.path.isfile(f) and not skipped(f):
+                h.update(f.encode())
+                _hash_file(h, f)
+    return h
+
+
+def _flutter_linux_build_key(cmd):
+    # Everything `flutter build linux` consumes: the command (CI swaps in
+    # flutter-elinux), the SDK, the pub lock, the Dart/native sources and
+    # librustdesk, which the bundle installs. Must be run in flutter/.
+    h = hashlib.blake2b(digest_size=8)
+    h.update(cmd.encode())
+    flutter = shutil.which(cmd.split()[0])
+    if flutter:
+        flutter = os.path.realpath(flutter)
+        h.update(flutter.encode())
+        engine = os.path.join(os.path.dirname(flutter), 'internal', 'engine.version')
+        if os.path.isfile(engine):
+            h.update(pathlib.Path(engine).read_bytes())
+    # Leave out what flutter itself generates under linux/, it does not
+    # exist yet on the first build of a clean tree.
+    _hash_inputs(h, ['pubspec.yaml', 'pubspec.lock', '../target/release/liblibrustdesk.so',
+                     'lib', 'linux', 'assets'],
+                 skip=['linux/flutter/ephemeral', 'linux/flutter/generated_*'])
+    return h.hexdigest()
+
+
+def flutter_build_linux(cmd):
+    # Reuse the bundle of a previous build with identical inputs, e.g. when
+    # several packages are built from the same commit. Only the latest bundle
+    # is kept.
+    key = _flutter_linux_build_key(cmd)
+    cache_root = get_cache_dir('flutter')
+    cache = os.path.join(cache_root, key)
+    if os.path.isdir(cache):
+        print(f'Reuse cached flutter bundle {cache}')
+        if os.path.isdir(flutter_build_dir):
+            shutil.rmtree(flutter_build_dir)
+        shutil.copytree(cache, flutter_build_dir, symlinks=True)
+        return
+    system2(cmd)
+    if os.path.isdir(cache_root):
+        shutil.rmtree(cache_root)
+    shutil.copytree(flutter_build_dir, cache + '.tmp', symlinks=True)
+    os.replace(cache + '.tmp', cache)
+
+
+def strip_once(path):
+    # Skip strip when the binary is still the one stripped last time, so it
+    # is not rewritten and keeps its mtime. The stamp holds the digest of
+    # the stripped file and lives in the cache dir, not next to the binary,
+    # which may be packaged as a whole directory.
+    key = hashlib.md5(os.path.abspath(path).encode()).hexdigest()
+    stamp = pathlib.Path(get_cache_dir('strip', key))
+    if stamp.is_file() and stamp.read_text() == _file_md5(path):
+        print(f'{path} already stripped')
+        return
+    system2(['strip', path])
+    stamp.parent.mkdir(parents=True, exist_ok=True)
+    stamp.write_text(_file_md5(path))
+
+
+def _pack_flutter_deb(version, pairs):
+    # Stage the package in a fresh temporary directory next to the sources,
+    # the generated control file goes straight into it and nothing is left
+    # behind in the tree.
+    with tempfile.TemporaryDirectory(prefix='tmpdeb', dir='.') as tmpdeb:
+        os.chmod(tmpdeb, 0o755)
+        _stage_deb_tree(tmpdeb, pairs, dirs=['usr/bin'])
+        _write_polkit_stub(tmpdeb)
+        shutil.copytree('../res/DEBIAN', f'{tmpdeb}/DEBIAN', dirs_exist_ok=True)
+        generate_control_file(version, f'{tmpdeb}/DEBIAN/control')
+        write_md5sums(tmpdeb)
+        dpkg_deb_build(tmpdeb, 'rustdesk.deb')
+    os.replace('rustdesk.deb', '../rustdesk-%s.deb' % version)
 
 
 def build_flutter_deb(version, features):
@@ -326,89 +579,120 @@ def build_flutter_deb(version, features):
         system2(f'cargo build --features {features} --lib --release')
         ffi_bindgen_function_refactor()
     os.chdir('flutter')
-    system2('flutter build linux --release')
-    system2('mkdir -p tmpdeb/usr/bin/')
-    system2('mkdir -p tmpdeb/usr/lib/rustdesk')
-    system2('mkdir -p tmpdeb/etc/rustdesk/')
-    system2('mkdir -p tmpdeb/etc/pam.d/')
-    system2('mkdir -p tmpdeb/usr/share/rustdesk/files/systemd/')
-    system2('mkdir -p tmpdeb/usr/share/icons/hicolor/256x256/apps/')
-    system2('mkdir -p tmpdeb/usr/share/icons/hicolor/scalable/apps/')
-    system2('mkdir -p tmpdeb/usr/share/applications/')
-    system2('mkdir -p tmpdeb/usr/share/polkit-1/actions')
-    system2('rm tmpdeb/usr/bin/rustdesk || true')
-    system2(
-        f'cp -r {flutter_build_dir}/* tmpdeb/usr/lib/rustdesk/')
-    system2(
-        'cp ../res/rustdesk.service tmpdeb/usr/share/rustdesk/files/systemd/')
-    system2(
-        'cp ../res/128x128@2x.png tmpdeb/usr/share/icons/hicolor/256x256/apps/rustdesk.png')
-    system2(
-        'cp ../res/scalable.svg tmpdeb/usr/share/icons/hicolor/scalable/apps/rustdesk.svg')
-    system2(
-        'cp ../res/rustdesk.desktop tmpdeb/usr/share/applications/rustdesk.desktop')
-    system2(
-        'cp ../res/rustdesk-link.desktop tmpdeb/usr/share/applications/rustdesk-link.desktop')
-    system2(
-        'cp ../res/com.rustdesk.RustDesk.policy tmpdeb/usr/share/polkit-1/actions/')
-    system2(
-        'cp ../res/startwm.sh tmpdeb/etc/rustdesk/')
-    system2(
-        'cp ../res/xorg.conf tmpdeb/etc/rustdesk/')
-    system2(
-        'cp ../res/pam.d/rustdesk.debian tmpdeb/etc/pam.d/rustdesk')
-    system2(
-        "echo \"#!/bin/sh\" >> tmpdeb/usr/share/rustdesk/files/polkit && chmod a+x tmpdeb/usr/share/rustdesk/files/polkit")
-
-    system2('mkdir -p tmpdeb/DEBIAN')
-    generate_control_file(version)
-    system2('cp -a ../res/DEBIAN/* tmpdeb/DEBIAN/')
-    md5_file('usr/share/rustdesk/files/systemd/rustdesk.service')
-    system2('dpkg-deb -b tmpdeb rustdesk.deb;')
-
-    system2('/bin/rm -rf tmpdeb/')
-    system2('/bin/rm -rf ../res/DEBIAN/control')
-    os.rename('rustdesk.deb', '../rustdesk-%s.deb' % version)
+    flutter_build_linux('flutter build linux --release')
+    _pack_flutter_deb(version, [
+        (flutter_build_dir, 'usr/lib/rustdesk'),
+        ('../res/rustdesk.service', 'usr/share/rustdesk/files/systemd/rustdesk.service'),
+        ('../res/128x128@2x.png', 'usr/share/icons/hicolor/256x256/apps/rustdesk.png'),
+        ('../res/scalable.svg', 'usr/share/icons/hicolor/scalable/apps/rustdesk.svg'),
+        ('../res/rustdesk.desktop', 'usr/share/applications/rustdesk.desktop'),
+        ('../res/rustdesk-link.desktop', 'usr/share/applications/rustdesk-link.desktop'),
+        ('../res/com.rustdesk.RustDesk.policy', 'usr/share/polkit-1/actions/com.rustdesk.RustDesk.policy'),
+        ('../res/startwm.sh', 'etc/rustdesk/startwm.sh'),
+        ('../res/xorg.conf', 'etc/rustdesk/xorg.conf'),
+        ('../res/pam.d/rustdesk.debian', 'etc/pam.d/rustdesk'),
+    ])
     os.chdir("..")
 
 
 def build_deb_from_folder(version, binary_folder):
     os.chdir('flutter')
-    system2('mkdir -p tmpdeb/usr/bin/')
-    system2('mkdir -p tmpdeb/usr/lib/rustdesk')
-    system2('mkdir -p tmpdeb/usr/share/rustdesk/files/systemd/')
-    system2('mkdir -p tmpdeb/usr/share/icons/hicolor/256x256/apps/')
-    system2('mkdir -p tmpdeb/usr/share/icons/hicolor/scalable/apps/')
-    system2('mkdir -p tmpdeb/usr/share/applications/')
-    system2('mkdir -p tmpdeb/usr/share/polkit-1/actions')
-    system2('rm tmpdeb/usr/bin/rustdesk || true')
-    system2(
-        f'cp -r ../{binary_folder}/* tmpdeb/usr/lib/rustdesk/')
-    system2(
-        'cp ../res/rustdesk.service tmpdeb/usr/share/rustdesk/files/systemd/')
-    system2(
-        'cp ../res/128x128@2x.png tmpdeb/usr/share/icons/hicolor/256x256/apps/rustdesk.png')
-    system2(
-        'cp ../res/scalable.svg tmpdeb/usr/share/icons/hicolor/scalable/apps/rustdesk.svg')
-    system2(
-        'cp ../res/rustdesk.desktop tmpdeb/usr/share/applications/rustdesk.desktop')
-    system2(
-        'cp ../res/rustdesk-link.desktop tmpdeb/usr/share/applications/rustdesk-link.desktop')
-    system2(
-        'cp ../res/com.rustdesk.RustDesk.policy tmpdeb/usr/share/polkit-1/actions/')
-    system2(
-        "echo \"#!/bin/sh\" >> tmpdeb/usr/share/rustdesk/files/polkit && chmod a+x tmpdeb/usr/share/rustdesk/files/polkit")
+    _pack_flutter_deb(version, [
+        (f'../{binary_folder}', 'usr/lib/rustdesk'),
+        ('../res/rustdesk.service', 'usr/share/rustdesk/files/systemd/rustdesk.service'),
+        ('../res/128x128@2x.png', 'usr/share/icons/hicolor/256x256/apps/rustdesk.png'),
+        ('../res/scalable.svg', 'usr/share/icons/hicolor/scalable/apps/rustdesk.svg'),
+        ('../res/rustdesk.desktop', 'usr/share/applications/rustdesk.desktop'),
+        ('../res/rustdesk-link.desktop', 'usr/share/applications/rustdesk-link.desktop'),
+        ('../res/com.rustdesk.RustDesk.policy', 'usr/share/polkit-1/actions/com.rustdesk.RustDesk.policy'),
+    ])
+    os.chdir("..")
 
-    system2('mkdir -p tmpdeb/DEBIAN')
-    generate_control_file(version)
-    system2('cp -a ../res/DEBIAN/* tmpdeb/DEBIAN/')
-    md5_file('usr/share/rustdesk/files/systemd/rustdesk.service')
-    system2('dpkg-deb -b tmpdeb rustdesk.deb;')
 
-    system2('/bin/rm -rf tmpdeb/')
-    system2('/bin/rm -rf ../res/DEBIAN/control')
-    os.rename('rustdesk.deb', '../rustdesk-%s.deb' % version)
-    os.chdir("..")
+def build_deb(version):
+    # Repack the deb made by `cargo bundle` with our resources, maintainer
+    # scripts and libsciter.
+    bundle_dir = pathlib.Path('target/release/bundle/deb')
+    pairs = [
+        ('res/rustdesk.service', 'usr/share/rustdesk/files/systemd/rustdesk.service'),
+        ('res/128x128@2x.png', 'usr/share/icons/hicolor/256x256/apps/rustdesk.png'),
+        ('res/scalable.svg', 'usr/share/icons/hicolor/scalable/apps/rustdesk.svg'),
+        ('res/rustdesk.desktop', 'usr/share/applications/rustdesk.desktop'),
+        ('res/rustdesk-link.desktop', 'usr/share/applications/rustdesk-link.desktop'),
+        ('res/startwm.sh', 'etc/rustdesk/startwm.sh'),
+        ('res/xorg.conf', 'etc/X11/rustdesk/xorg.conf'),
+        ('res/pam.d/rustdesk.debian', 'etc/pam.d/rustdesk'),
+        ('libsciter-gtk.so', 'usr/lib/rustdesk/libsciter-gtk.so'),
+    ]
+    # cargo bundle names its output after the target arch, which ARCH does
+    # not necessarily match, so look the staged tree up instead
+    staged = [p for p in bundle_dir.glob(f'rustdesk_{version}_*')
+              if (p / 'data').is_dir() and (p / 'control').is_dir()]
+    bundle = staged[0] if len(staged) == 1 else None
+    if not bundle:
+        debs = sorted(bundle_dir.glob('rustdesk*.deb'))
+        if len(debs) != 1:
+            print(f"Expected one rustdesk*.deb in {bundle_dir}, found {len(debs)}. Exiting.")
+            sys.exit(-1)
+        bundle_deb = debs[0]
+
+    # The package only depends on these inputs, so reuse the deb of a
+    # previous build with identical ones. Only the latest deb is kept.
+    # cargo bundle rewrites its tarballs and the .deb on every run and they
+    # record the fresh mtimes, so only the staged tree can be keyed on. The
+    # fallback, which has nothing but the .deb, is never cached.
+    cached = None
+    if bundle:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f'{version} {get_arch()} {get_deb_compression()}'.encode())
+        inputs = [os.path.abspath(__file__), 'res/DEBIAN'] + [src for (src, _) in pairs]
+        inputs += [str(bundle / 'data'), str(bundle / 'control')]
+        _hash_inputs(h, inputs)
+        cached = get_cache_dir('debs', f'{h.hexdigest()}.deb')
+    if cached and os.path.isfile(cached):
+        print(f'Reuse cached deb {cached}')
+        shutil.copy2(cached, 'rustdesk-%s.deb' % version)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='tmpdeb', dir='.') as tmpdeb:
+        os.chmod(tmpdeb, 0o755)
+        # cargo bundle leaves the tree it packed next to the .deb, start from
+        # that instead of unpacking the package again
+        if bundle:
+            shutil.copytree(bundle / 'data', tmpdeb, symlinks=True, dirs_exist_ok=True)
+            shutil.copytree(bundle / 'control', f'{tmpdeb}/DEBIAN', dirs_exist_ok=True)
+        else:
+            shutil.move(bundle_deb, 'rustdesk.deb')
+            system2(['dpkg-deb', '-R', 'rustdesk.deb', tmpdeb])
+        # strip straight into place instead of strip + mv, the binary is written
+        # once and hashed from page cache by write_md5sums. Stage the resources
+        # while strip runs, they do not touch the binary.
+        strip_cmd = ['strip', '-o', f'{tmpdeb}/usr/lib/rustdesk/rustdesk', f'{tmpdeb}/usr/bin/rustdesk']
+        os.makedirs(f'{tmpdeb}/usr/lib/rustdesk', exist_ok=True)
+        strip = subprocess.Popen(strip_cmd, close_fds=False)
+        try:
+            _stage_deb_tree(tmpdeb, pairs)
+            shutil.copytree('res/DEBIAN', f'{tmpdeb}/DEBIAN', dirs_exist_ok=True)
+        except BaseException:
+            # do not leave strip writing into the tree that is removed next
+            strip.kill()
+            strip.wait()
+            raise
+        if strip.wait() != 0:
+            print(f"Error occurred when executing: {strip_cmd}. Exiting.")
+            sys.exit(-1)
+        os.remove(f'{tmpdeb}/usr/bin/rustdesk')
+        write_md5sums(tmpdeb)
+        dpkg_deb_build(tmpdeb, 'rustdesk.deb')
+
+    if cached:
+        cache_root = os.path.dirname(cached)
+        if os.path.isdir(cache_root):
+            shutil.rmtree(cache_root)
+        os.makedirs(cache_root)
+        shutil.copy2('rustdesk.deb', cached + '.tmp')
+        os.replace(cached + '.tmp', cached)
+    os.replace('rustdesk.deb', 'rustdesk-%s.deb' % version)
 
 
 def build_flutter_dmg(version, features):
@@ -417,14 +701,14 @@ def build_flutter_dmg(version, features):
         system2(
             f'MACOSX_DEPLOYMENT_TARGET=10.14 cargo build --features {features} --lib --release')
     # copy dylib
-    system2(
-        "cp target/release/liblibrustdesk.dylib target/release/librustdesk.dylib")
+    shutil.copy2("target/release/liblibrustdesk.dylib",
+                 "target/release/librustdesk.dylib")
     os.chdir('flutter')
     system2('flutter build macos --release')
     '''
     system2(
         "create-dmg --volname \"RustDesk Installer\" --window-pos 200 120 --window-size 800 400 --icon-size 100 --app-drop-link 600 185 --icon RustDesk.app 200 190 --hide-extension RustDesk.app rustdesk.dmg ./build/macos/Build/Products/Release/RustDesk.app")
-    os.rename("rustdesk.dmg", f"../rustdesk-{version}.dmg")
+    os.replace("rustdesk.dmg", f"../rustdesk-{version}.dmg")
     '''
     os.chdir("..")
 
@@ -434,12 +718,26 @@ def build_flutter_arch_manjaro(version, features):
         system2(f'cargo build --features {features} --lib --release')
     ffi_bindgen_function_refactor()
     os.chdir('flutter')
-    system2('flutter build linux --release')
-    system2(f'strip {flutter_build_dir}/lib/librustdesk.so')
+    flutter_build_linux('flutter build linux --release')
+    strip_once(f'{flutter_build_dir}/lib/librustdesk.so')
     os.chdir('../res')
     system2('HBB=`pwd`/.. FLUTTER=1 makepkg -f')
 
 
+def pip_install_requirements():
+    # Skip resolving requirements.txt again when neither it nor the pip in
+    # use changed since the last successful install in this directory.
+    stamp = pathlib.Path('.reqs.stamp')
+    pip = shutil.which('pip3') or ''
+    current = hashlib.sha256(
+        pip.encode() + pathlib.Path('requirements.txt').read_bytes()).hexdigest()
+    if stamp.exists() and stamp.read_text() == current:
+        print('requirements.txt unchanged, skip pip install')
+        return
+    system2('pip3 install -r requirements.txt')
+    stamp.write_text(current)
+
+
 def build_flutter_windows(version, features, skip_portable_pack):
     if not skip_cargo:
         system2(f'cargo build --features {features} --lib --release')
@@ -454,19 +752,15 @@ def build_flutter_windows(version, features, skip_portable_pack):
     if skip_portable_pack:
         return
     os.chdir('libs/portable')
-    system2('pip3 install -r requirements.txt')
+    pip_install_requirements()
     system2(
         f'python3 ./generate.py -f ../../{flutter_build_dir_2} -o . -e ../../{flutter_build_dir_2}/rustdesk.exe')
     os.chdir('../..')
-    if os.path.exists('./rustdesk_portable.exe'):
-        os.replace('./target/release/rustdesk-portable-packer.exe',
-                   './rustdesk_portable.exe')
-    else:
-        os.rename('./target/release/rustdesk-portable-packer.exe',
-                  './rustdesk_portable.exe')
+    os.replace('./target/release/rustdesk-portable-packer.exe',
+               './rustdesk_portable.exe')
     print(
         f'output location: {os.path.abspath(os.curdir)}/rustdesk_portable.exe')
-    os.rename('./rustdesk_portable.exe', f'./rustdesk-{version}-install.exe')
+    os.replace('./rustdesk_portable.exe', f'./rustdesk-{version}-install.exe')
     print(
         f'output location: {os.path.abspath(os.curdir)}/rustdesk-{version}-install.exe')
 
@@ -482,6 +776,7 @@ def main():
         system2('git checkout src/ui/common.tis')
     version = get_version()
     features = ','.join(get_features(args))
+    setup_cargo_cache()
     flutter = args.flutter
     if not flutter:
         system2('python3 res/inline-sciter.py')
@@ -506,7 +801,7 @@ def main():
             return
         system2('cargo build --release --features ' + features)
         # system2('upx.exe target/release/rustdesk.exe')
-        system2('mv target/release/rustdesk.exe target/release/RustDesk.exe')
+        shutil.move('target/release/rustdesk.exe', 'target/release/RustDesk.exe')
         pa = os.environ.get('P')
         if pa:
             # https://certera.com/kb/tutorial-guide-for-safenet-authentication-client-for-code-signing/
@@ -515,46 +810,43 @@ def main():
                 'target\\release\\rustdesk.exe')
         else:
             print('Not signed')
-        system2(
-            f'cp -rf target/release/RustDesk.exe {res_dir}')
+        shutil.copy2('target/release/RustDesk.exe', res_dir)
         os.chdir('libs/portable')
-        system2('pip3 install -r requirements.txt')
+        pip_install_requirements()
         system2(
             f'python3 ./generate.py -f ../../{res_dir} -o . -e ../../{res_dir}/rustdesk-{version}-win7-install.exe')
-        system2('mv ../../{res_dir}/rustdesk-{version}-win7-install.exe ../..')
+        os.replace(f'../../{res_dir}/rustdesk-{version}-win7-install.exe',
+                   f'../../rustdesk-{version}-win7-install.exe')
     elif os.path.isfile('/usr/bin/pacman'):
         # pacman -S -needed base-devel
-        system2("sed -i 's/pkgver=.*/pkgver=%s/g' res/PKGBUILD" % version)
+        replace_in_file('res/PKGBUILD', [(r'pkgver=.*', 'pkgver=%s' % version)])
         if flutter:
             build_flutter_arch_manjaro(version, features)
         else:
             system2('cargo build --release --features ' + features)
             system2('git checkout src/ui/common.tis')
-            system2('strip target/release/rustdesk')
-            system2('ln -s res/pacman_install && ln -s res/PKGBUILD')
+            strip_once('target/release/rustdesk')
+            os.symlink('res/pacman_install', 'pacman_install')
+            os.symlink('res/PKGBUILD', 'PKGBUILD')
             system2('HBB=`pwd` makepkg -f')
-        system2('mv rustdesk-%s-0-x86_64.pkg.tar.zst rustdesk-%s-manjaro-arch.pkg.tar.zst' % (
-            version, version))
+        os.replace('rustdesk-%s-0-x86_64.pkg.tar.zst' % version,
+                   'rustdesk-%s-manjaro-arch.pkg.tar.zst' % version)
         # pacman -U ./rustdesk.pkg.tar.zst
     elif os.path.isfile('/usr/bin/yum'):
         system2('cargo build --release --features ' + features)
-        system2('strip target/release/rustdesk')
-        system2(
-            "sed -i 's/Version:    .*/Version:    %s/g' res/rpm.spec" % version)
+        strip_once('target/release/rustdesk')
+        replace_in_file('res/rpm.spec', [(r'Version:    .*', 'Version:    %s' % version)])
         system2('HBB=`pwd` rpmbuild -ba res/rpm.spec')
-        system2(
-            'mv $HOME/rpmbuild/RPMS/x86_64/rustdesk-%s-0.x86_64.rpm ./rustdesk-%s-fedora28-centos8.rpm' % (
-                version, version))
+        shutil.move(os.path.expanduser('~/rpmbuild/RPMS/x86_64/rustdesk-%s-0.x86_64.rpm' % version),
+                    './rustdesk-%s-fedora28-centos8.rpm' % version)
         # yum localinstall rustdesk.rpm
     elif os.path.isfile('/usr/bin/zypper'):
         system2('cargo build --release --features ' + features)
-        system2('strip target/release/rustdesk')
-        system2(
-            "sed -i 's/Version:    .*/Version:    %s/g' res/rpm-suse.spec" % version)
+        strip_once('target/release/rustdesk')
+        replace_in_file('res/rpm-suse.spec', [(r'Version:    .*', 'Version:    %s' % version)])
         system2('HBB=`pwd` rpmbuild -ba res/rpm-suse.spec')
-        system2(
-            'mv $HOME/rpmbuild/RPMS/x86_64/rustdesk-%s-0.x86_64.rpm ./rustdesk-%s-suse.rpm' % (
-                version, version))
+        shutil.move(os.path.expanduser('~/rpmbuild/RPMS/x86_64/rustdesk-%s-0.x86_64.rpm' % version),
+                    './rustdesk-%s-suse.rpm' % version)
         # yum localinstall rustdesk.rpm
     else:
         if flutter:
@@ -568,12 +860,15 @@ def main():
         else:
             system2('cargo bundle --release --features ' + features)
             if osx:
-                system2(
-                    'strip target/release/bundle/osx/RustDesk.app/Contents/MacOS/rustdesk')
-                system2(
-                    'cp libsciter.dylib target/release/bundle/osx/RustDesk.app/Contents/MacOS/')
+                strip_once('target/release/bundle/osx/RustDesk.app/Contents/MacOS/rustdesk')
+                shutil.copy2('libsciter.dylib',
+                             'target/release/bundle/osx/RustDesk.app/Contents/MacOS/')
                 # https://github.com/sindresorhus/create-dmg
-                system2('/bin/rm -rf *.dmg')
+                for dmg in pathlib.Path('.').glob('*.dmg'):
+                    if dmg.is_dir():
+                        shutil.rmtree(dmg)
+                    else:
+                        dmg.unlink()
                 pa = os.environ.get('P')
                 if pa:
                     system2('''
@@ -586,10 +881,12 @@ def main():
     codesign -s "Developer ID Application: {0}" --force --options runtime  ./target/release/bundle/osx/RustDesk.app/Contents/MacOS/*
     codesign -s "Developer ID Application: {0}" --force --options runtime  ./target/release/bundle/osx/RustDesk.app
     '''.format(pa))
+                # ULFO (lzfse) is much faster to create than the default
+                # zlib UDZO and is readable on macOS 10.11+
                 system2(
-                    'create-dmg "RustDesk %s.dmg" "target/release/bundle/osx/RustDesk.app"' % version)
-                os.rename('RustDesk %s.dmg' %
-                          version, 'rustdesk-%s.dmg' % version)
+                    'create-dmg --format ULFO "RustDesk %s.dmg" "target/release/bundle/osx/RustDesk.app"' % version)
+                os.replace('RustDesk %s.dmg' %
+                           version, 'rustdesk-%s.dmg' % version)
                 if pa:
                     system2('''
     # https://pyoxidizer.readthedocs.io/en/apple-codesign-0.14.0/apple_codesign.html
@@ -607,46 +904,92 @@ def main():
                 else:
                     print('Not signed')
             else:
-                # build deb package
-                system2(
-                    'mv target/release/bundle/deb/rustdesk*.deb ./rustdesk.deb')
-                system2('dpkg-deb -R rustdesk.deb tmpdeb')
-                system2('mkdir -p tmpdeb/usr/share/rustdesk/files/systemd/')
-                system2('mkdir -p tmpdeb/usr/share/icons/hicolor/256x256/apps/')
-                system2('mkdir -p tmpdeb/usr/share/icons/hicolor/scalable/apps/')
-                system2(
-                    'cp res/rustdesk.service tmpdeb/usr/share/rustdesk/files/systemd/')
-                system2(
-                    'cp res/128x128@2x.png tmpdeb/usr/share/icons/hicolor/256x256/apps/rustdesk.png')
-                system2(
-                    'cp res/scalable.svg tmpdeb/usr/share/icons/hicolor/scalable/apps/rustdesk.svg')
-                system2(
-                    'cp res/rustdesk.desktop tmpdeb/usr/share/applications/rustdesk.desktop')
-                system2(
-                    'cp res/rustdesk-link.desktop tmpdeb/usr/share/applications/rustdesk-link.desktop')
-                os.system('mkdir -p tmpdeb/etc/rustdesk/')
-                os.system('cp -a res/startwm.sh tmpdeb/etc/rustdesk/')
-                os.system('mkdir -p tmpdeb/etc/X11/rustdesk/')
-                os.system('cp res/xorg.conf tmpdeb/etc/X11/rustdesk/')
-                os.system('cp -a DEBIAN/* tmpdeb/DEBIAN/')
-                os.system('mkdir -p tmpdeb/etc/pam.d/')
-                os.system('cp pam.d/rustdesk.debian tmpdeb/etc/pam.d/rustdesk')
-                system2('strip tmpdeb/usr/bin/rustdesk')
-                system2('mkdir -p tmpdeb/usr/lib/rustdesk')
-                system2('mv tmpdeb/usr/bin/rustdesk tmpdeb/usr/lib/rustdesk/')
-                system2('cp libsciter-gtk.so tmpdeb/usr/lib/rustdesk/')
-                md5_file('usr/share/rustdesk/files/systemd/rustdesk.service')
-                md5_file('etc/rustdesk/startwm.sh')
-                md5_file('etc/X11/rustdesk/xorg.conf')
-                md5_file('etc/pam.d/rustdesk')
-                md5_file('usr/lib/rustdesk/libsciter-gtk.so')
-                system2('dpkg-deb -b tmpdeb rustdesk.deb; /bin/rm -rf tmpdeb/')
-                os.rename('rustdesk.deb', 'rustdesk-%s.deb' % version)
-
-
-def md5_file(fn):
-    md5 = hashlib.md5(open('tmpdeb/' + fn, 'rb').read()).hexdigest()
-    system2('echo "%s %s" >> tmpdeb/DEBIAN/md5sums' % (md5, fn))
+                build_deb(version)
+
+
+def _hash_file(h, path):
+    with open(path, 'rb', buffering=0) as fh:
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+ ships the same readinto loop
+            return hashlib.file_digest(fh, lambda: h)
+        # Feed the file through one reused 1 MiB buffer, hashlib releases the
+        # GIL for buffers this large.
+        buf = bytearray(1 << 20)
+        view = memoryview(buf)
+        while n := fh.readinto(buf):
+            h.update(view[:n])
+    return h
+
+
+def _file_md5(path):
+    return _hash_file(hashlib.md5(), path).hexdigest()
+
+
+def dpkg_deb_build(root, deb):
+    cmd = ['dpkg-deb', f'-Z{get_deb_compression()}']
+    # Let the compressor use every core. --threads-max needs dpkg >= 1.21.9.
+    try:
+        usage = subprocess.run(['dpkg-deb', '--help'], capture_output=True, text=True).stdout
+    except OSError:
+        usage = ''
+    if '--threads-max' in usage:
+        cmd.append(f'--threads-max={os.cpu_count()}')
+    system2(cmd + ['-b', root, deb])
+
+
+def _load_md5_cache():
+    try:
+        with open(get_cache_dir('md5.json'), encoding='utf-8') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_md5_cache(cache):
+    path = get_cache_dir('md5.json')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as fh:
+        json.dump(cache, fh)
+    os.replace(path + '.tmp', path)
+
+
+def write_md5sums(root):
+    # Write DEBIAN/md5sums for every regular file of the staged package in
+    # one go. hashlib releases the GIL while hashing, so files are hashed in
+    # parallel.
+    files = []
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        if dirpath == root:
+            dirnames[:] = [d for d in dirnames if d != 'DEBIAN']
+        for f in filenames:
+            path = os.path.join(dirpath, f)
+            if os.path.isfile(path) and not os.path.islink(path):
+                files.append(path)
+    # Start with the largest files (librustdesk, libsciter-gtk, the binary)
+    # so the small ones are hashed alongside them instead of after them.
+    files.sort(key=os.path.getsize, reverse=True)
+    cache = _load_md5_cache()
+    used = {}
+
+    def md5(path):
+        # Staged files are fresh copies, but shutil.copy2 keeps the mtime, so
+        # path, size and mtime identify unchanged content across builds. The
+        # path is relative to root, which is a new temporary directory each
+        # time.
+        st = os.stat(path)
+        key = f'{os.path.relpath(path, root)}:{st.st_size}:{st.st_mtime_ns}'
+        digest = cache.get(key) or _file_md5(path)
+        used[key] = digest
+        return digest
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        digests = list(executor.map(md5, files))
+    # only keep what this build used, so the cache does not grow forever
+    _save_md5_cache(used)
+    sums = sorted((os.path.relpath(path, root), digest)
+                  for (path, digest) in zip(files, digests))
+    with open(os.path.join(root, 'DEBIAN', 'md5sums'), 'w') as fh:
+        fh.writelines(f'{digest}  {path}\n' for (path, digest) in sums)
 
 
 if __name__ == "__main__":